@@ -6,6 +6,7 @@ DATASET_PATH = "raw_data"
 MASTER_PATH = "datasets"
 
 DEBUG = False
+RESUME = False
 
 if __name__ == "__main__":
     adapter = AnimalToYOLODatasetAdapter(
@@ -18,9 +19,9 @@ if __name__ == "__main__":
         f'Train dataset size is {adapter.get_split_size("train")} (images). Test dataset size is {adapter.get_split_size("test")} (images)'
     )
 
-    adapter.convert(MASTER_PATH)
+    adapter.convert(MASTER_PATH, resume=RESUME)
 
-    class_names = [name for name, _ in adapter.label_lookup]
+    class_names = adapter.labels
     config = {
         "path": MASTER_PATH,
         "train": "train/images",
@@ -1,17 +1,127 @@
 # source code https://www.kaggle.com/code/momiradzemovic/animal-detection-yolov8/notebook
+import errno
+import io
 import os
-from pathlib import Path
 import random
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 import shutil
-from typing import Dict, List, Tuple, Optional, Iterable
-from collections import defaultdict, Counter
+from itertools import islice
+from typing import Dict, List, Tuple, Optional, Iterable, Iterator
+from collections import Counter
 import cv2
+import numpy as np
 from networkx import NodeNotFound
+from PIL import Image
 from tqdm import tqdm
 from lookupTable import LookupTable
 
-DatasetIndex = Dict[str, Dict[str, List[str]]]
+try:
+    from turbojpeg import TurboJPEG
+
+    # libjpeg-turbo SIMD decoder, used by `load_image` when available
+    turbo_jpeg: Optional[TurboJPEG] = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    turbo_jpeg = None
+
+# Index keeps only sample counts (split -> label -> n_samples),
+# sample ids are streamed from disk when needed
+DatasetIndex = Dict[str, Dict[str, int]]
 DatasetStats = Dict[str, int]
+# Sample ids stored in more than one label directory
+# (split -> sample_id -> labels), all other ids belong to a single label
+SharedSamples = Dict[str, Dict[str, List[str]]]
+# Columnar (column -> values) layout of a split, one row per sample.
+# Columns are "labels" and "sample_ids".
+SplitColumns = Dict[str, np.ndarray]
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# (label_index, x_center, y_center, width, height)
+YOLO_ANNOT_LINE = "%d %.6f %.6f %.6f %.6f\n"
+# Number of samples submitted to conversion workers at once
+CONVERT_CHUNK_SIZE = 1024
+# Errors of `os.link` for which copying is used instead
+# (different filesystems, linking not permitted or not supported)
+LINK_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EMLINK,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+}
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Hard links file to the new location. Falls back to copying file
+    contents if linking is not possible (e.g. different filesystems).
+    Linked file shares data with the source, so it must not be modified
+    in place (e.g. copied over), otherwise the source is modified too.
+
+    File is transferred under temporary name and renamed to destination,
+    so interrupted transfer never leaves truncated file at destination.
+    Existing destination is replaced (not written through).
+
+    Args:
+        src: Source path
+        dst: Destination path
+    """
+    tmp_dst = f"{dst}.tmp"
+    # Leftover of interrupted transfer may be a link to another file, so it is
+    # removed instead of being copied over
+    if os.path.lexists(tmp_dst):
+        os.unlink(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+    except OSError as e:
+        if e.errno not in LINK_UNSUPPORTED_ERRNOS:
+            raise
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def get_exif_orientation(image: Image.Image) -> int:
+    """
+    Reads EXIF orientation from image header (image is not decoded).
+
+    Args:
+        image: Opened image
+
+    Returns:
+        EXIF orientation (1 if not set)
+    """
+    return image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+
+
+def parse_annot_line(line: str) -> Tuple[str, float, float, float, float]:
+    """
+    Parses annotation line "<label> <x_min> <y_min> <x_max> <y_max>".
+    Label name may contain spaces, so coordinates are split from the right.
+
+    Args:
+        line: Annotation line
+
+    Returns:
+        Label name and box coordinates
+    """
+    label, x_min, y_min, x_max, y_max = line.rsplit(None, 4)
+    return label, float(x_min), float(y_min), float(x_max), float(y_max)
+
+
+def scan_sample_ids(label_path: str) -> Iterator[str]:
+    """
+    Args:
+        label_path: Label (class) directory path
+
+    Returns:
+        Iterator over sample ids (image names) in the directory
+    """
+    with os.scandir(label_path) as it:
+        for entry in it:
+            if entry.name.endswith(".jpg") and entry.is_file():
+                yield entry.name[:-4]
 
 
 class AnimalToYOLODatasetAdapter:
@@ -31,14 +141,23 @@ class AnimalToYOLODatasetAdapter:
             self.split_stats,
             self.label_lookup,
             self._size,
+            self._shared_samples,
         ) = self._index_dataset(path, label_filter)
+        # Plain dict snapshot of the lookup for hot paths
+        self._label_to_idx: Dict[str, int] = dict(self.label_lookup)
+        # Split columns are materialized only for random sampling
+        self._split_columns: Dict[str, SplitColumns] = {}
 
     @staticmethod
     def _index_dataset(
         path: str, label_filter: Optional[List[str]] = None
-    ) -> Tuple[DatasetIndex, DatasetStats, DatasetStats, LookupTable, int]:
+    ) -> Tuple[
+        DatasetIndex, DatasetStats, DatasetStats, LookupTable, int, SharedSamples
+    ]:
         """
-        Creates datast index. Index is mapping (split -> label -> sample_id).
+        Creates datast index. Index is mapping (split -> label -> n_samples).
+        Sample ids are validated but not retained (see `_iter_samples`),
+        except for the ids shared by several label directories.
         Input dataset format is given in previosly defined structure.
 
         Args:
@@ -46,49 +165,86 @@ class AnimalToYOLODatasetAdapter:
             label_filter: Filter used labels
 
         Returns:
-            Dataset index, Label stats, Split stats, dataset size
+            Dataset index, Label stats, Split stats, dataset size, shared samples
         """
-        index: DatasetIndex = defaultdict(dict)
-        label_stats: DatasetStats = Counter()
-        split_stats: DatasetStats = Counter()
+        index: DatasetIndex = {}
+        shared_samples: SharedSamples = {}
         lookup = LookupTable(add_unknown_token=False)
-        size = 0
 
-        splits = os.listdir(path)
+        with os.scandir(path) as it:
+            splits = [entry.name for entry in it if entry.is_dir()]
+        split_label_dirs: Dict[str, List[str]] = {}
         for split in splits:
+            with os.scandir(os.path.join(path, split)) as it:
+                split_label_dirs[split] = [
+                    entry.name for entry in it if entry.is_dir()
+                ]
+
+        progress = tqdm(
+            total=sum(len(labels) for labels in split_label_dirs.values()),
+            desc="Indexing",
+            unit="class",
+        )
+        for split, labels in split_label_dirs.items():
             split_path = os.path.join(path, split)
-            labels = os.listdir(split_path)
-            for label in tqdm(labels, desc=f"Indexing {split}", unit="sample"):
+            index[split] = {}
+            shared_samples[split] = {}
+            # First label of every sample id, dropped once the split is indexed
+            sample_labels: Dict[str, str] = {}
+            for label in labels:
+                progress.update(1)
                 if label_filter is not None and label not in label_filter:
                     continue
 
                 label_path = os.path.join(split_path, label)
-                sample_ids = [
-                    Path(filename).stem
-                    for filename in os.listdir(label_path)
-                    if filename != "Label" and filename.endswith(".jpg")
-                ]
+                sample_ids = set(scan_sample_ids(label_path))
                 annotations_path = os.path.join(label_path, "Label")
-                annot_sample_ids = [
-                    Path(filename).stem
-                    for filename in os.listdir(annotations_path)
-                    if filename.endswith(".txt")
-                ]
-                assert set(sample_ids) == set(
-                    annot_sample_ids
+                with os.scandir(annotations_path) as it:
+                    annot_sample_ids = {
+                        entry.name[:-4] for entry in it if entry.name.endswith(".txt")
+                    }
+                assert (
+                    sample_ids == annot_sample_ids
                 ), "Image sample ids and annotation sample ids do not match"
 
-                # Update index, stats and lookup
-                index[split][label] = sample_ids
+                # Update index and lookup
+                index[split][label] = len(sample_ids)
+                lookup.add(label)
 
-                n_samples = len(sample_ids)
-                label_stats[label] += n_samples
-                split_stats[split] += n_samples
-                size += n_samples
+                for sample_id in sample_ids:
+                    first_label = sample_labels.setdefault(sample_id, label)
+                    if first_label != label:
+                        shared_samples[split].setdefault(
+                            sample_id, [first_label]
+                        ).append(label)
+        progress.close()
+
+        # Stats are derived from the index counts
+        label_stats: DatasetStats = Counter()
+        for split_index in index.values():
+            label_stats.update(split_index)
+        label_stats = dict(label_stats)
+        split_stats: DatasetStats = {
+            split: sum(split_index.values()) for split, split_index in index.items()
+        }
+        size = sum(split_stats.values())
 
-                lookup.add(label)
+        return index, label_stats, split_stats, lookup, size, shared_samples
 
-        return dict(index), dict(label_stats), dict(split_stats), lookup, size
+    def _iter_samples(self, split: str) -> Iterator[Tuple[str, str]]:
+        """
+        Streams split samples from disk.
+
+        Args:
+            split: Split
+
+        Returns:
+            Iterator over tuples (label, sample_id)
+        """
+        split_path = os.path.join(self._path, split)
+        for label in self._index[split]:
+            for sample_id in scan_sample_ids(os.path.join(split_path, label)):
+                yield label, sample_id
 
     def __len__(self) -> int:
         return self._size
@@ -99,7 +255,7 @@ class AnimalToYOLODatasetAdapter:
         Returns:
             List of labels (classes) in lookup table
         """
-        return list(self.label_lookup)
+        return [label for label, _ in self.label_lookup]
 
     @property
     def n_labels(self) -> int:
@@ -114,6 +270,7 @@ class AnimalToYOLODatasetAdapter:
     ) -> List[Tuple[str, str, str]]:
         """
         Fetchen `n` random samples from dataset for chosen split.
+        Samples are drawn uniformly (with replacement) over the whole split.
 
         Args:
             n: Number of samples
@@ -122,17 +279,27 @@ class AnimalToYOLODatasetAdapter:
         Returns:
             List of tuples (split, label, sample_id)
         """
-        split_index = self._index[split]
-        label_names, _ = zip(*self.labels)
-
-        result: List[Tuple[str, str, str]] = []
-        for i in range(n):
-            label = random.choice(label_names)
-            sample_ids = split_index[label]
-            sample_id = random.choice(sample_ids)
-            result.append((split, label, sample_id))
-
-        return result
+        split_size = self.split_stats[split]
+        if split_size == 0:
+            raise ValueError(f'Split "{split}" has no samples!')
+
+        split_columns = self._split_columns.get(split)
+        if split_columns is None:
+            labels, sample_ids = zip(*self._iter_samples(split))
+            split_columns = {
+                "labels": np.array(labels, dtype=object),
+                "sample_ids": np.array(sample_ids, dtype=object),
+            }
+            self._split_columns[split] = split_columns
+
+        idx = random.choices(range(len(split_columns["labels"])), k=n)
+        return list(
+            zip(
+                [split] * n,
+                split_columns["labels"][idx],
+                split_columns["sample_ids"][idx],
+            )
+        )
 
     def get_split_size(self, split: str) -> int:
         """
@@ -155,21 +322,54 @@ class AnimalToYOLODatasetAdapter:
         """
         return os.path.join(self._path, split, label, f"{sample_id}.jpg")
 
-    def load_image(self, split: str, label: str, sample_id: str) -> str:
+    def load_image(self, split: str, label: str, sample_id: str) -> np.ndarray:
         """
+        Decodes image with libjpeg-turbo if available and image is not rotated
+        by EXIF orientation, otherwise with OpenCV.
+
         Args:
             split: Split
             label: Label (token)
             sample_id: Sample id
 
         Returns:
-            Loaded image
+            Loaded image (BGR)
         """
         image_path = self.get_image_path(split, label, sample_id)
         if not os.path.exists(image_path):
             raise NodeNotFound(f'Image "{image_path}" not found!')
+        if turbo_jpeg is not None:
+            with open(image_path, "rb") as f:
+                data = f.read()
+            try:
+                # TurboJPEG ignores EXIF orientation, while `cv2.imread` applies it
+                with Image.open(io.BytesIO(data)) as image:
+                    orientation = get_exif_orientation(image)
+                if orientation == 1:
+                    return turbo_jpeg.decode(data)
+            except OSError:
+                pass  # Not a valid JPEG (e.g. misnamed PNG), OpenCV handles it
         return cv2.imread(image_path)
 
+    @staticmethod
+    def _read_image_size(image_path: str) -> Tuple[int, int]:
+        """
+        Reads image size from the file header, taking EXIF orientation into
+        account the same way as `cv2.imread` does.
+
+        Args:
+            image_path: Image path
+
+        Returns:
+            Image width and height
+        """
+        with Image.open(image_path) as image:
+            w, h = image.size
+            # Orientations 5-8 are rotated by 90 degrees, so sides are swapped
+            if get_exif_orientation(image) in (5, 6, 7, 8):
+                w, h = h, w
+        return w, h
+
     def get_annot_path(self, split: str, label: str, sample_id: str) -> str:
         """
         Animal dataset annotation path convention.
@@ -200,66 +400,158 @@ class AnimalToYOLODatasetAdapter:
         """
         annot_path = self.get_annot_path(split, label, sample_id)
         with open(annot_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        annots: List[Tuple[str, float, float, float, float]] = []
-        for l in lines:
-            items = l.split()
-            label_name = " ".join(items[:-4])
-            coords = [float(v) for v in items[-4:]]
-            annots.append([label_name, *coords])
-        return annots
+            text = f.read()
+        return [parse_annot_line(line) for line in text.splitlines()]
 
-    def convert(self, path: str) -> None:
+    def _iter_sample_groups(self, split: str) -> Iterator[Tuple[str, List[str]]]:
         """
-        Converts dataset tp YOLO format.
+        Streams split samples from disk grouped by sample id. Only the ids
+        shared by several label directories are kept in memory.
 
         Args:
-            path: Output path
+            split: Split
+
+        Returns:
+            Iterator over tuples (sample_id, labels)
         """
-        for split in self._index:
-            split_path = os.path.join(path, split)
-            images_path = os.path.join(split_path, "images")
-            labels_path = os.path.join(split_path, "labels")
-            Path(images_path).mkdir(parents=True, exist_ok=True)
-            Path(labels_path).mkdir(parents=True, exist_ok=True)
-
-            for label, sample_ids in tqdm(
-                self._index[split].items(),
-                desc="Converting to Yolo format",
-                total=len(self._index[split]),
-            ):
-                assert len(sample_ids) == len(set(sample_ids))
-                for sample_id in sample_ids:
-                    image_path = self.get_image_path(split, label, sample_id)
-                    new_image_path = os.path.join(images_path, f"{sample_id}.jpg")
-                    annots = self.parse_annot(split, label, sample_id)
-                    new_annot_path = os.path.join(labels_path, f"{sample_id}.txt")
-
-                    # Image needs to be loaded in order to read width and height
-                    # which are required for coordinate normalization
-                    image = self.load_image(split, label, sample_id)
-                    h, w, _ = image.shape
-
-                    # Conversion
-                    converted_annot: List[Tuple[int, float, float, float, float]] = []
-                    for label, x_min, y_min, x_max, y_max in annots:
-                        label_index = self.label_lookup[label]
-                        x_center = (x_min + x_max) / (2 * w)
-                        y_center = (y_min + y_max) / (2 * h)
-                        width = (x_max - x_min) / w
-                        height = (y_max - y_min) / h
-
-                        converted_annot.append(
-                            (label_index, x_center, y_center, width, height)
-                        )
+        shared_samples = self._shared_samples[split]
+        for label, sample_id in self._iter_samples(split):
+            if sample_id not in shared_samples:
+                yield sample_id, [label]
+        yield from shared_samples.items()
+
+    def _get_n_sample_groups(self, split: str) -> int:
+        """
+        Returns:
+            Number of distinct sample ids (output samples) in split
+        """
+        n_duplicates = sum(
+            len(labels) - 1 for labels in self._shared_samples[split].values()
+        )
+        return self.split_stats[split] - n_duplicates
+
+    def _convert_sample(
+        self,
+        src_split_path: str,
+        images_path: str,
+        labels_path: str,
+        image_size: Optional[Tuple[int, int]],
+        resume: bool,
+        sample_id: str,
+        labels: List[str],
+    ) -> None:
+        """
+        Converts single sample to YOLO format. Annotations of the sample
+        from all label directories are merged into one output file.
+        Paths are built with f-strings from precomputed split prefixes
+        (same convention as `get_image_path` and `get_annot_path`).
 
-                    # Save data
-                    with open(new_annot_path, "a", encoding="utf-8") as f:
-                        converted_annot_lines = [
-                            " ".join([str(v) for v in row]) for row in converted_annot
-                        ]
-                        f.write("\n".join(converted_annot_lines))
-                        f.write("\n")
+        Args:
+            src_split_path: Input split path
+            images_path: Output images path
+            labels_path: Output labels path
+            image_size: Known image width and height (read from image if not set)
+            resume: Skip sample if its image and merged annotation already exist
+            sample_id: Sample id
+            labels: Labels (tokens) of directories containing the sample
+        """
+        # Image is the same in every label directory
+        image_path = f"{src_split_path}/{labels[0]}/{sample_id}.jpg"
+        new_image_path = f"{images_path}/{sample_id}.jpg"
+        new_annot_path = f"{labels_path}/{sample_id}.txt"
+        if (
+            resume
+            and os.path.exists(new_image_path)
+            and os.path.exists(new_annot_path)
+        ):
+            return
+
+        # Image is transferred first and both files are renamed into place only
+        # when complete, so existing annotation implies complete sample.
+        # Existing image is complete too (this task owns the sample id)
+        if not os.path.exists(new_image_path):
+            link_or_copy(image_path, new_image_path)
+
+        # Width and height are required for coordinate normalization
+        if image_size is None:
+            image_size = self._read_image_size(image_path)
+        w, h = image_size
+        inv_w, inv_h = 1.0 / w, 1.0 / h
+        half_inv_w, half_inv_h = 0.5 * inv_w, 0.5 * inv_h
+
+        # Parsing, conversion and formatting are done in a single pass
+        # over annotation lines (files hold only a few boxes each)
+        label_to_idx = self._label_to_idx
+        converted_annot_lines: List[str] = []
+        for label in labels:
+            annot_path = f"{src_split_path}/{label}/Label/{sample_id}.txt"
+            with open(annot_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    ann_label, x_min, y_min, x_max, y_max = parse_annot_line(line)
+                    converted_annot_lines.append(
+                        YOLO_ANNOT_LINE
+                        % (
+                            label_to_idx[ann_label],
+                            (x_min + x_max) * half_inv_w,
+                            (y_min + y_max) * half_inv_h,
+                            (x_max - x_min) * inv_w,
+                            (y_max - y_min) * inv_h,
+                        )
+                    )
+
+        # Save data. File is truncated, so re-runs do not duplicate annotations.
+        # It is written under temporary name and renamed only when complete,
+        # so existing annotation always holds boxes from all label directories
+        tmp_annot_path = f"{new_annot_path}.tmp"
+        with open(tmp_annot_path, "w", encoding="utf-8") as f:
+            f.write("".join(converted_annot_lines))
+        os.replace(tmp_annot_path, new_annot_path)
+
+    def convert(
+        self,
+        path: str,
+        n_workers: Optional[int] = None,
+        image_size: Optional[Tuple[int, int]] = None,
+        resume: bool = False,
+    ) -> None:
+        """
+        Converts dataset tp YOLO format.
+        Samples are converted in a thread pool, one task per output sample id,
+        so no two workers write the same image or annotation file.
 
-                    if not os.path.exists(new_image_path):
-                        shutil.copy(image_path, new_image_path)
+        Args:
+            path: Output path
+            n_workers: Number of worker threads (defaults to CPU count)
+            image_size: Width and height shared by all images. If set, image
+                headers are not read (use only for datasets with uniform size)
+            resume: Skip sample ids which are already converted (e.g. after
+                interrupted run). Annotations are rewritten otherwise
+        """
+        with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+            for split in self._index:
+                split_path = os.path.join(path, split)
+                images_path = os.path.join(split_path, "images")
+                labels_path = os.path.join(split_path, "labels")
+                Path(images_path).mkdir(parents=True, exist_ok=True)
+                Path(labels_path).mkdir(parents=True, exist_ok=True)
+
+                convert_sample = partial(
+                    self._convert_sample,
+                    os.path.join(self._path, split),
+                    images_path,
+                    labels_path,
+                    image_size,
+                    resume,
+                )
+                # Samples are streamed from disk and submitted in bounded chunks,
+                # so neither index nor pending tasks hold the whole split
+                samples = self._iter_sample_groups(split)
+                with tqdm(
+                    desc="Converting to Yolo format",
+                    total=self._get_n_sample_groups(split),
+                    unit="sample",
+                ) as progress:
+                    while chunk := list(islice(samples, CONVERT_CHUNK_SIZE)):
+                        sample_ids, labels = zip(*chunk)
+                        for _ in executor.map(convert_sample, sample_ids, labels):
+                            progress.update(1)